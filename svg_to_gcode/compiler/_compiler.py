@@ -1,3 +1,5 @@
+from functools import lru_cache
+import string
 from typing import List, Tuple, Type
 import warnings
 
@@ -7,9 +9,14 @@ from svg_to_gcode.compiler.interfaces import Interface
 from svg_to_gcode.geometry import Curve, Line, Vector
 from svg_to_gcode.geometry import LineSegmentChain
 from svg_to_gcode import UNITS, TOLERANCES
-from shapely.geometry import Point, LineString, MultiLineString
 from shapely.geometry.polygon import Polygon
 import numpy as np
+import shapely
+
+try:
+    import numba
+except ImportError:  # numba is optional, polygons are filled with the numpy implementation without it
+    numba = None
 
 """
 TODO:
@@ -19,6 +26,101 @@ Consider its outer box and
 follow https://stackoverflow.com/questions/36399381/whats-the-fastest-way-of-checking-if-a-point-is-inside-a-polygon-in-python
 """
 
+
+# Number of scanlines _scanline_segments intersects at once, memory grows with it times the number of edges
+_SCANLINE_BLOCK_SIZE = 1024
+
+
+def _scanline_segments(edges: np.ndarray, offsets: np.ndarray, min_length: float) -> np.ndarray:
+    """
+    Intersects horizontal scanlines with a polygon using the even-odd rule.
+
+    :param edges: (E, 2, 2) array of the polygon edges, [[x0, y0], [x1, y1]] for each edge.
+    :param offsets: the y value of each scanline.
+    :param min_length: segments this short or shorter are dropped, they are floating point noise.
+    :return: (K, 2, 2) array of the scanline segments lying inside the polygon, ordered by scanline then by increasing x.
+    """
+    blocks = [
+        _scanline_block_segments(edges, offsets[i:i + _SCANLINE_BLOCK_SIZE], min_length)
+        for i in range(0, len(offsets), _SCANLINE_BLOCK_SIZE)
+    ]
+    return np.concatenate(blocks) if blocks else np.empty((0, 2, 2))
+
+
+def _scanline_block_segments(edges: np.ndarray, offsets: np.ndarray, min_length: float) -> np.ndarray:
+    """
+    Computes _scanline_segments for a block of scanlines, all of their edge crossings at once.
+    """
+    x0, y0 = edges[:, 0, 0], edges[:, 0, 1]
+    x1, y1 = edges[:, 1, 0], edges[:, 1, 1]
+    y = offsets[:, np.newaxis]
+
+    # Half-open rule: a vertex lying on a scanline is only counted by one of the two edges it joins
+    crossed = (y0 <= y) != (y1 <= y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_cross = np.where(crossed, x0 + (y - y0) / (y1 - y0) * (x1 - x0), np.inf)
+    x_cross.sort(axis=1)
+
+    # Every pair of consecutive crossings encloses a segment inside the polygon
+    pairs = x_cross.shape[1] // 2
+    x_start = x_cross[:, 0:2 * pairs:2]
+    x_end = x_cross[:, 1:2 * pairs:2]
+    with np.errstate(invalid="ignore"):
+        scanline, pair = np.nonzero(np.isfinite(x_end) & (x_end - x_start > min_length))
+
+    y_segment = offsets[scanline]
+    return np.stack([
+        np.column_stack([x_start[scanline, pair], y_segment]),
+        np.column_stack([x_end[scanline, pair], y_segment])
+    ], axis=1)
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _scanline_segments_compiled(edges: np.ndarray, offsets: np.ndarray, min_length: float) -> np.ndarray:
+        """
+        Compiled equivalent of _scanline_segments. Scanlines are processed one at a time, so that memory doesn't grow
+        with the number of scanlines times the number of edges.
+        """
+        crossings = np.empty(edges.shape[0])
+        segments = np.empty((max(4 * offsets.shape[0], 16), 2, 2))
+        count = 0
+
+        for i in range(offsets.shape[0]):
+            y = offsets[i]
+
+            # Insertion sort of the crossings, a scanline only crosses a few edges
+            crossing_count = 0
+            for j in range(edges.shape[0]):
+                x0, y0 = edges[j, 0, 0], edges[j, 0, 1]
+                x1, y1 = edges[j, 1, 0], edges[j, 1, 1]
+
+                # Half-open rule: a vertex lying on a scanline is only counted by one of the two edges it joins
+                if (y0 <= y) != (y1 <= y):
+                    x_cross = x0 + (y - y0) / (y1 - y0) * (x1 - x0)
+                    k = crossing_count
+                    while k > 0 and crossings[k - 1] > x_cross:
+                        crossings[k] = crossings[k - 1]
+                        k -= 1
+                    crossings[k] = x_cross
+                    crossing_count += 1
+
+            for k in range(0, crossing_count - 1, 2):
+                if crossings[k + 1] - crossings[k] > min_length:
+                    if count == segments.shape[0]:
+                        grown = np.empty((2 * count, 2, 2))
+                        grown[:count] = segments
+                        segments = grown
+
+                    segments[count, 0, 0] = crossings[k]
+                    segments[count, 0, 1] = y
+                    segments[count, 1, 0] = crossings[k + 1]
+                    segments[count, 1, 1] = y
+                    count += 1
+
+        return segments[:count]
+
+
 class Compiler:
     """
     The Compiler class handles the process of drawing geometric objects using interface commands and assembling
@@ -98,54 +200,61 @@ class Compiler:
 
     def compile(self):
         """
-        Assembles the code in the header, body and footer, saving it to a file.
+        Assembles the code in the header, body and footer.
 
-        :param passes: the number of passes that should be made. Every pass the machine moves_down (z-axis) by
-        self.pass_depth and self.body is repeated.
         :return returns the assembled code. self.header + [self.body, -self.pass_depth] * passes + self.footer
         """
+        return '\n'.join(self.compile_iter())
 
+    def compile_iter(self):
+        """
+        Assembles the code in the header, body and footer, yielding it one command at a time. Unlike self.compile, the
+        assembled code is never held in memory as a whole: only the cutting body, which is repeated every pass, is
+        yielded as a single block of commands.
+
+        Every pass the machine moves_down (z-axis) by self.pass_depth and self.body_cut is repeated.
+        :return returns an iterator over the non-empty commands of self.header + [self.body, -self.pass_depth] * passes
+        + self.footer
+        """
+        return (command for command in self._assemble() if command)
+
+    def _assemble(self):
         if (len(self.body_draw) + len(self.body_cut)) == 0:
             warnings.warn("Compile with an empty body (no curves). Is this intentional?")
 
-        gcode = []
-
-        gcode.extend(self.header)
-        gcode.append(self.interface.set_unit(self.unit))
+        yield from self.header
+        yield self.interface.set_unit(self.unit)
 
         self.interface.set_movement_speed(self.movement_speed)
         # Set z for drawing
-        gcode.append(self.interface.linear_move(z=(self.drawing_z-self.initial_z)))
+        yield self.interface.linear_move(z=(self.drawing_z-self.initial_z))
 
         if len(self.body_draw):
             # Add gcode for drawing first
-            gcode.extend(["; Start drawing"])
-            gcode.extend(self.body_draw)
+            yield "; Start drawing"
+            yield from self.body_draw
 
         if len(self.body_cut) > 0:
-            gcode.extend(["; Start cutting"])
+            yield "; Start cutting"
             # Set z for cutting
-            # gcode.append(self.interface.linear_move(z=(self.cutting_z-self.drawing_z)))
-            gcode.append(self.interface.linear_move(z=self.cutting_z))
+            # yield self.interface.linear_move(z=(self.cutting_z-self.drawing_z))
+            yield self.interface.linear_move(z=self.cutting_z)
 
-            # Add gcode for cutting
+            # Add gcode for cutting. The body is joined once and repeated as a single block for every pass
+            body_cut = '\n'.join(filter(None, self.body_cut))
             for i in range(self.cutting_passes):
-                gcode.extend([f"; Pass {i+1}/{self.cutting_passes}"])
-                gcode.extend(self.body_cut)
+                yield f"; Pass {i+1}/{self.cutting_passes}"
+                yield body_cut
 
                 if i < self.cutting_passes - 1:  # If it isn't the last pass, turn off the laser and move down
-                    gcode.append(self.interface.laser_off())
+                    yield self.interface.laser_off()
 
                     if self.pass_depth > 0:
-                        gcode.append(self.interface.set_relative_coordinates())
-                        gcode.append(self.interface.linear_move(z=-self.pass_depth))
-                        gcode.append(self.interface.set_absolute_coordinates())
+                        yield self.interface.set_relative_coordinates()
+                        yield self.interface.linear_move(z=-self.pass_depth)
+                        yield self.interface.set_absolute_coordinates()
 
-        gcode.extend(self.footer)
-
-        gcode = filter(lambda command: len(command) > 0, gcode)
-
-        return '\n'.join(gcode)
+        yield from self.footer
 
     def apply_offset(self):
         offset_x = 0
@@ -155,7 +264,8 @@ class Compiler:
     # def compile_to_file(self, file_name: str, passes=1):
     def compile_to_file(self, file_name: str):
         """
-        A wrapper for the self.compile method. Assembles the code in the header, body and footer, saving it to a file.
+        A wrapper for the self.compile_iter method. Assembles the code in the header, body and footer, saving it to a
+        file.
 
         :param file_name: the path to save the file.
         :param passes: the number of passes that should be made. Every pass the machine moves_down (z-axis) by
@@ -163,9 +273,11 @@ class Compiler:
         """
         print("Generating Gcode file...")
 
-        with open(file_name, 'w') as file:
-            # file.write(self.compile(passes=passes))
-            file.write(self.compile())
+        # Stream the commands through a 64 KiB buffer instead of joining the whole program into a single string
+        with open(file_name, 'w', buffering=1 << 16) as file:
+            commands = self.compile_iter()
+            file.write(next(commands, ''))
+            file.writelines('\n' + command for command in commands)
 
 
     def append_polygon(
@@ -188,12 +300,10 @@ class Compiler:
         # if len(points) == 0:
         #     # warnings.warn("Polygon has no point inside.")
         #     return []
-        x, y = lines[0].xy  
-        
         code = []
 
         # start = points[0].start
-        start = Vector(x[0], y[0])#points[0]
+        start = Vector(*lines[0].coords[0])#points[0]
 
         if self.interface.position is None or abs(self.interface.position - start) > TOLERANCES["operation"]:
 
@@ -205,15 +315,16 @@ class Compiler:
                 code = [self.interface.dwell(self.dwell_time)] + code
         
         for line in lines:
-            x, y = line.xy
-            code.append(self.interface.linear_move(x[0], y[0]))
+            coords = line.coords
+            (x0, y0), (x1, y1) = coords[0], coords[-1]
+            code.append(self.interface.linear_move(x0, y0))
             code.append(self.interface.set_movement_speed(self.cutting_speed))
             code.append(self.interface.set_laser_power(self.cutting_power))
-            code.append(self.interface.linear_move(x[1], y[1]))
+            code.append(self.interface.linear_move(x1, y1))
             code.append(self.interface.laser_off())
             code.append(self.interface.set_movement_speed(self.movement_speed))
-       
-        self.body_draw.extend(code)
+
+        self._extend_body(self.body_draw, code)
 
         # Don't dwell and turn off laser if the new start is at the current position
         # if self.interface.position is None or abs(self.interface.position - start) > TOLERANCES["operation"]:
@@ -280,12 +391,24 @@ class Compiler:
             if self.dwell_time > 0:
                 code = [self.interface.dwell(self.dwell_time)] + code
 
-        for line in line_chain:
-            code.append(self.interface.linear_move(line.end.x, line.end.y))
+        code.extend(self.interface.linear_moves([line.end for line in line_chain]))
         if cut:
-            self.body_cut.extend(code)
+            self._extend_body(self.body_cut, code)
         else:
-            self.body_draw.extend(code)
+            self._extend_body(self.body_draw, code)
+
+    @staticmethod
+    def _extend_body(body: List[str], code: List[str]):
+        """
+        Extends a body with code, dropping empty commands and commands repeating the previous one. Bodies only contain
+        absolute moves and state changes, repeating them right away has no effect.
+        """
+        last_command = body[-1] if body else None
+
+        for command in code:
+            if command and command != last_command:
+                body.append(command)
+                last_command = command
 
 
     def append_curves(self, curves: List[Curve]):
@@ -294,25 +417,32 @@ class Compiler:
         appended to self.body
         """
         print("Transforming Bezier curves to line segments...")
-        for curve in tqdm.tqdm(curves):
-
-            line_chain = LineSegmentChain()
-
-            approximation = LineSegmentChain.line_segment_approximation(curve)
-
-            line_chain.extend(approximation)
-
-            self.append_line_chain(line_chain, curve.cut)
+        # The progress bar only pays off for large drawings, and refreshing it on every curve slows the loop down
+        for curve in tqdm.tqdm(curves, mininterval=0.5, disable=len(curves) < 100):
+            # The approximation already is a continuous LineSegmentChain, there is no need to copy it into a new one
+            self.append_line_chain(LineSegmentChain.line_segment_approximation(curve), curve.cut)
     
 
-    def color_to_grey(self, color: str) -> int:
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def color_to_grey(color: str) -> int:
         """
-        NTSC formula: 0.299 x Red + 0.587 x Green + 0.114 x Blue.
+        NTSC formula: 0.299 x Red + 0.587 x Green + 0.114 x Blue, computed in integers so that greys map to themselves.
+        Drawings only use a handful of colors, so results are cached.
         https://stackoverflow.com/questions/29643352/converting-hex-to-rgb-value-in-python
+
+        :param color: A #rgb or #rrggbb hex color. Only the first six digits of longer colors (eg. #rrggbbaa) are used.
         """
-        color = color.lstrip("#")
-        r,g,b = tuple(int(color[i:i+2], 16) for i in (0, 2, 4))
-        return int(0.299*r + 0.587*g + 0.114*b)
+        digits = color.lstrip("#")
+        if len(digits) == 3:
+            digits = "".join(digit * 2 for digit in digits)
+
+        if len(digits) < 6 or not all(digit in string.hexdigits for digit in digits):
+            raise ValueError(f"Unknown color {color}. Please specify it as a #rgb or #rrggbb hex color.")
+
+        rgb = int(digits[:6], 16)
+        r, g, b = (rgb >> 16) & 255, (rgb >> 8) & 255, rgb & 255
+        return (299*r + 587*g + 114*b) // 1000
     
 
     def get_density(self,
@@ -320,13 +450,7 @@ class Compiler:
         grey_value: int
     ) -> int:
         laser_diameter = 2 # In mm
-        xx, yy = polygon.exterior.coords.xy
-        xx = np.array(xx)
-        yy = np.array(yy)
-        x_min = xx.min()
-        x_max = xx.max()
-        y_min = yy.min()
-        y_max = yy.max()
+        x_min, y_min, x_max, y_max = polygon.bounds
         
         maximum_density = max(y_max-y_min, x_max-x_min) / laser_diameter
         # print(maximum_density)
@@ -368,36 +492,40 @@ class Compiler:
             grid = np.arange(0,  square_length + step, step)
             
             if orientation == "diagonal":
-                
-                for i in range(1, len(grid)):
-                    # line = LineString([[grid[i], square_box_low[1]], [square_box_low[0], grid[i]]])
-                    line = LineString([[square_box_low[0] + grid[i], square_box_low[1]], [square_box_low[0], square_box_low[1] + grid[i]]])
-                    intersection = polygon.intersection(line)
-                    # print(intersection)
-                    if isinstance(intersection, MultiLineString):
-                        # x,y = intersection.xy
-                        for l in intersection.geoms:
-                            if not l.is_empty:
-                                res.append(l)
-                    else:
-                        # x,y = intersection.xy
-                        if not intersection.is_empty:
-                            res.append(intersection)
-
-                for i in range(1, len(grid)-1):
-                    # line = LineString([[square_box_high[0], grid[i]], [grid[i], square_box_high[1]]])
-                    line = LineString([[square_box_high[0] - grid[i], square_box_high[1]], [square_box_high[0], square_box_high[1] - grid[i]]])
-                    intersection = polygon.intersection(line)
-                    
-                    if isinstance(intersection, MultiLineString):
-                        # x,y = intersection.xy
-                        for l in intersection.geoms:
-                            if not l.is_empty:
-                                res.append(l)
-                    else:
-                        # x,y = intersection.xy
-                        if not intersection.is_empty:
-                            res.append(intersection)
+                # Turn the polygon by 45° (and scale it by √2) so that the diagonal scanlines become horizontal.
+                # Lines going up-left from the bottom edge of the square box are swept first, with the along-line
+                # axis mirrored so that the segments keep that direction, then lines going down-right from its top edge.
+                rings = [polygon.exterior] + list(polygon.interiors)
+                edges = np.concatenate([
+                    np.stack([coords[:-1], coords[1:]], axis=1)
+                    for coords in (np.asarray(ring.coords)[:, :2] for ring in rings)
+                ])
+                sweeps = [
+                    (square_box_low[0] + square_box_low[1] + grid[1:], 1),
+                    (square_box_high[0] + square_box_high[1] - grid[1:-1], -1)
+                ]
+
+                scanline_segments = _scanline_segments if numba is None else _scanline_segments_compiled
+
+                segments = []
+                for offsets, direction in sweeps:
+                    turned_edges = np.stack([
+                        direction * (edges[..., 1] - edges[..., 0]),
+                        edges[..., 0] + edges[..., 1]
+                    ], axis=-1)
+
+                    # Scanlines outside the extent of the polygon can't cross it, nor can edges parallel to the scanlines.
+                    # Like the half-open rule, the extent includes its lower bound and excludes its upper bound.
+                    edge_offsets = turned_edges[..., 1]
+                    offsets = offsets[(offsets >= edge_offsets.min()) & (offsets < edge_offsets.max())]
+                    turned_edges = turned_edges[edge_offsets[:, 0] != edge_offsets[:, 1]]
+
+                    turned_segments = scanline_segments(turned_edges, offsets, TOLERANCES["operation"])
+                    along = direction * turned_segments[..., 0]
+                    across = turned_segments[..., 1]
+                    segments.append(np.stack([(across - along) / 2, (across + along) / 2], axis=-1))
+
+                res = list(shapely.linestrings(np.concatenate(segments)))
         return res
 
 
@@ -427,10 +555,9 @@ class Compiler:
 
         sample = sample[sample[:, 0].argsort()]
 
-        res = []
-        for point in sample:
-            if polygon.contains(Point(point[0], point[1])):
-                res.append(Vector(point[0], point[1]))
+        shapely.prepare(polygon)
+        inside = sample[shapely.contains_xy(polygon, sample[:, 0], sample[:, 1])]
+        res = [Vector(x, y) for x, y in inside]
         
         if len(res) > 0:
             print(f"Generated {len(res)} points for polygon with grey_value = {grey_value}, density = {density}")
@@ -446,11 +573,7 @@ class Compiler:
         for area in areas:
             edges = []
             for curve in area["curves"]:
-                line_chain = LineSegmentChain()
-                approximation = LineSegmentChain.line_segment_approximation(curve)
-                # print(approximation)
-                line_chain.extend(approximation)
-                # print(line_chain._curves)
+                line_chain = LineSegmentChain.line_segment_approximation(curve)
                 # edges.extend([(l.start, l.end) for l in line_chain._curves])
                 edges.extend([(l.start.x, l.start.y) for l in line_chain._curves])
             polygon = Polygon(edges)
@@ -1,3 +1,5 @@
+from typing import List
+
 from svg_to_gcode.geometry import Vector
 
 
@@ -31,6 +33,15 @@ class Interface:
         """
         raise NotImplementedError("Interface class must implement the linear_move command")
 
+    def linear_moves(self, points: List[Vector]) -> List[str]:
+        """
+        Moves the tool in straight lines through a sequence of points. Equivalent to calling linear_move for each point,
+        child classes may override it with a faster implementation.
+
+        :return: Appropriate commands, one per point.
+        """
+        return [self.linear_move(point.x, point.y) for point in points]
+
     def laser_off(self) -> str:
         """
         Powers off the laser beam.
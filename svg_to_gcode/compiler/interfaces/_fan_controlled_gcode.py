@@ -14,8 +14,14 @@ class FanControlledGcode(Gcode):
     def set_laser_power(self, power):
         self._current_power = power
 
+        command = self._laser_power_commands.get(power)
+        if command is not None:
+            return command
+
         if power < 0 or power > 1:
             raise ValueError(f"{power} is out of bounds. Laser power must be given between 0 and 1. "
                              f"The interface will scale it correctly.")
 
-        return f"M106 S{formulas.linear_map(0, 255, power)};"
+        command = f"M106 S{formulas.linear_map(0, 255, power)};"
+        self._laser_power_commands[power] = command
+        return command
@@ -16,6 +16,9 @@ class Gcode(Interface):
         self._next_speed = None
         self._current_speed = None
 
+        # Formatted laser power commands, the same few power levels are set before every cut
+        self._laser_power_commands = {}
+
         # Round outputs to the same number of significant figures as the operational tolerance.
         self.precision = abs(round(math.log(TOLERANCES["operation"], 10)))
 
@@ -59,15 +62,33 @@ class Gcode(Interface):
 
         return command + ';'
 
+    def linear_moves(self, points):
+        if verbose or not points:
+            return super().linear_moves(points)
+
+        # Only the first move can change the speed, the following ones are formatted directly
+        commands = [self.linear_move(points[0].x, points[0].y)]
+        commands.extend([f"G1 X{point.x:.{self.precision}f} Y{point.y:.{self.precision}f};" for point in points[1:]])
+
+        self.position = Vector(points[-1].x, points[-1].y)
+
+        return commands
+
     def laser_off(self):
         return f"M5;"
 
     def set_laser_power(self, power, minimum=0, maximum=1000):
+        command = self._laser_power_commands.get((power, minimum, maximum))
+        if command is not None:
+            return command
+
         if power < 0 or power > 1:
             raise ValueError(f"{power} is out of bounds. Laser power must be given between 0 and 1. "
                              f"The interface will scale it correctly.")
 
-        return f"M4 S{formulas.linear_map(minimum, maximum, power)};"
+        command = f"M4 S{formulas.linear_map(minimum, maximum, power)};"
+        self._laser_power_commands[(power, minimum, maximum)] = command
+        return command
 
     def set_absolute_coordinates(self):
         return "G90;"
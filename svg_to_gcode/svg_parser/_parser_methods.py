@@ -7,24 +7,75 @@ from svg_to_gcode.geometry import Curve
 
 NAMESPACES = {'svg': 'http://www.w3.org/2000/svg'}
 
+_SVG_PATH = "{%s}path" % NAMESPACES["svg"]
+_SVG_DEFS = "{%s}defs" % NAMESPACES["svg"]
+
 
 def _has_style(element: ElementTree.Element, key: str, value: str) -> bool:
     """
     Check if an element contains a specific key and value either as an independent attribute or in the style attribute.
     """
-    return element.get(key) == value or (element.get("style") and f"{key}:{value}" in element.get("style"))
+    if element.get(key) == value:
+        return True
+
+    style = element.get("style")
+    return style is not None and f"{key}:{value}" in style
 
 def is_path_filled(style):
     return "fill:" in style
 
+def _canvas_height(root: ElementTree.Element) -> float:
+    height_str = root.get("height")
+    return float(height_str) if height_str.isnumeric() else float(height_str[:-2])
+
+
+def _inherited_state(element: ElementTree.Element, parent_transformation, parent_visible: bool):
+    """
+    Compute the transformation and visibility of an element from the ones its parent passes on. They are passed on to
+    the element's children in turn.
+    """
+    # Children only read the inherited transformation, so it is only copied when the element extends it
+    transformation = parent_transformation
+
+    transform = element.get('transform')
+    if transform:
+        transformation = Transformation() if transformation is None else deepcopy(transformation)
+        transformation.add_transform(transform)
+
+    # Is the element and it's root not hidden?
+    visible = parent_visible and not (_has_style(element, "visibility", "hidden")
+                                      or _has_style(element, "visibility", "collapse"))
+    # Override inherited visibility
+    visible = visible or (_has_style(element, "visibility", "visible"))
+
+    return transformation, visible
+
+
+def _parse_path_custom(element: ElementTree.Element, canvas_height, transform_origin, transformation,
+                       curves: List[Curve], areas: List[dict]):
+    """
+    Parse a path element, appending its curves to curves and, if it is a closed and filled path, its area to areas.
+    """
+    style = element.attrib['style']
+    path_color = get_color(style, attribute="fill")
+    print(path_color)
+    cut = (path_color in ["#ff0000", "red"])
+    path = Path(element.attrib['d'], canvas_height, transform_origin, transformation, cut=cut)
+    curves.extend(path.curves)
+
+    if path.closed and is_path_filled(style):
+        area_color = get_color(style, attribute="fill")
+        areas.extend([{"curves": path.curves, "color": area_color}])
+
+
 # Todo deal with viewBoxes
 def parse_root_custom(root: ElementTree.Element, transform_origin=False, canvas_height=None, draw_hidden=False,
                visible_root=True, root_transformation=None) -> Tuple[List[Curve], List[dict]]:
 
     """
-    Recursively parse an etree root's children into geometric curves.
+    Parse an etree root's descendants into geometric curves and filled areas.
 
-    :param root: The etree element who's children should be recursively parsed. The root will not be drawn.
+    :param root: The etree element who's descendants should be parsed. The root will not be drawn.
     :param canvas_height: The height of the canvas. By default the height attribute of the root is used. If the root
     does not contain the height attribute, it must be either manually specified or transform must be False.
     :param transform_origin: Whether or not to transform input coordinates from the svg coordinate system to standard
@@ -38,52 +89,29 @@ def parse_root_custom(root: ElementTree.Element, transform_origin=False, canvas_
     areas = []
     
     if canvas_height is None:
-        height_str = root.get("height")
-        canvas_height = float(height_str) if height_str.isnumeric() else float(height_str[:-2])
+        canvas_height = _canvas_height(root)
 
-    # Draw visible elements (Depth-first search)
-    for element in list(root):
+    # Draw visible elements (Depth-first search). Elements are stacked with the transformation and visibility they
+    # inherit, children in reverse order so that they are popped in document order.
+    stack = [(element, root_transformation, visible_root) for element in reversed(root)]
+    while stack:
+        element, parent_transformation, parent_visible = stack.pop()
 
         # display cannot be overridden by inheritance. Just skip the element
         display = _has_style(element, "display", "none")
 
-        if display or element.tag == "{%s}defs" % NAMESPACES["svg"]:
+        if display or element.tag == _SVG_DEFS:
             continue
 
-        transformation = deepcopy(root_transformation) if root_transformation else None
-
-        transform = element.get('transform')
-        if transform:
-            transformation = Transformation() if transformation is None else transformation
-            transformation.add_transform(transform)
+        transformation, visible = _inherited_state(element, parent_transformation, parent_visible)
 
-        # Is the element and it's root not hidden?
-        visible = visible_root and not (_has_style(element, "visibility", "hidden")
-                                        or _has_style(element, "visibility", "collapse"))
-        # Override inherited visibility
-        visible = visible or (_has_style(element, "visibility", "visible"))
-
-        
-        
         # If the current element is opaque and visible, draw it
         if draw_hidden or visible:
-            if element.tag == "{%s}path" % NAMESPACES["svg"]:
-                style = element.attrib['style']
-                path_color = get_color(style, attribute="fill")
-                print(path_color)
-                cut = (path_color in ["#ff0000", "red"])
-                path = Path(element.attrib['d'], canvas_height, transform_origin, transformation, cut=cut)
-                curves.extend(path.curves)
-                
-                if path.closed and is_path_filled(style):
-                    area_color = get_color(style, attribute="fill")
-                    areas.extend([{"curves": path.curves, "color": area_color}])
-
+            if element.tag == _SVG_PATH:
+                _parse_path_custom(element, canvas_height, transform_origin, transformation, curves, areas)
 
-        # curves.extend(parse_root_custom(element, transform_origin, canvas_height, draw_hidden, visible, transformation))
-        curves_rec, areas_rec = parse_root_custom(element, transform_origin, canvas_height, draw_hidden, visible, transformation)
-        curves.extend(curves_rec)
-        areas.extend(areas_rec)
+        # Continue the search with the children of the element
+        stack.extend((child, transformation, visible) for child in reversed(element))
 
     # ToDo implement shapes class
     return curves, areas
@@ -109,8 +137,7 @@ def parse_root(root: ElementTree.Element, transform_origin=True, canvas_height=N
     
 
     if canvas_height is None:
-        height_str = root.get("height")
-        canvas_height = float(height_str) if height_str.isnumeric() else float(height_str[:-2])
+        canvas_height = _canvas_height(root)
 
     curves = []
 
@@ -120,25 +147,14 @@ def parse_root(root: ElementTree.Element, transform_origin=True, canvas_height=N
         # display cannot be overridden by inheritance. Just skip the element
         display = _has_style(element, "display", "none")
 
-        if display or element.tag == "{%s}defs" % NAMESPACES["svg"]:
+        if display or element.tag == _SVG_DEFS:
             continue
 
-        transformation = deepcopy(root_transformation) if root_transformation else None
-
-        transform = element.get('transform')
-        if transform:
-            transformation = Transformation() if transformation is None else transformation
-            transformation.add_transform(transform)
-
-        # Is the element and it's root not hidden?
-        visible = visible_root and not (_has_style(element, "visibility", "hidden")
-                                        or _has_style(element, "visibility", "collapse"))
-        # Override inherited visibility
-        visible = visible or (_has_style(element, "visibility", "visible"))
+        transformation, visible = _inherited_state(element, root_transformation, visible_root)
 
         # If the current element is opaque and visible, draw it
         if draw_hidden or visible:
-            if element.tag == "{%s}path" % NAMESPACES["svg"]:
+            if element.tag == _SVG_PATH:
                 path = Path(element.attrib['d'], canvas_height, transform_origin, transformation)
                 curves.extend(path.curves)
         # Continue the recursion
@@ -196,9 +212,10 @@ def parse_file(file_path: str, transform_origin=True, canvas_height=None, draw_h
 
 def parse_file_custom(file_path: str, transform_origin=False, canvas_height=None, draw_hidden=False) -> Tuple[List[Curve], List[dict]]:
     """
-            Recursively parse an svg file into geometric curves. (Wrapper for parse_root)
+            Parse an svg file into geometric curves and filled areas. Equivalent to calling parse_root_custom on the
+            file's root, but the file is streamed: elements are freed once parsed instead of loading the whole document.
 
-            :param file_path: The etree element who's children should be recursively parsed. The root will not be drawn.
+            :param file_path: The path of the svg file. The root will not be drawn.
             :param canvas_height: The height of the canvas. By default the height attribute of the root is used. If the root
             does not contain the height attribute, it must be either manually specified or transform_origin must be False.
             :param transform_origin: Whether or not to transform input coordinates from the svg coordinate system to standard cartesian
@@ -207,7 +224,35 @@ def parse_file_custom(file_path: str, transform_origin=False, canvas_height=None
             :return: A list of geometric curves describing the svg. Use the Compiler sub-module to compile them to gcode.
         """
     print("Parsing file...")
-    root = ElementTree.parse(file_path).getroot()
-    return parse_root_custom(root, transform_origin, canvas_height, draw_hidden)
-    
+    curves = []
+    areas = []
 
+    # The transformation and visibility each open element passes on to its children, None if they are not drawn
+    stack = []
+
+    for event, element in ElementTree.iterparse(file_path, events=("start", "end")):
+        if event == "end":
+            stack.pop()
+            element.clear()
+            continue
+
+        # The root is not drawn, nor are its transform and visibility inherited
+        if not stack:
+            if canvas_height is None:
+                canvas_height = _canvas_height(element)
+            stack.append((None, True))
+            continue
+
+        # display cannot be overridden by inheritance. Skip the element and its children
+        if stack[-1] is None or _has_style(element, "display", "none") or element.tag == _SVG_DEFS:
+            stack.append(None)
+            continue
+
+        transformation, visible = _inherited_state(element, *stack[-1])
+        stack.append((transformation, visible))
+
+        # If the current element is opaque and visible, draw it. Its attributes are complete on the start event.
+        if (draw_hidden or visible) and element.tag == _SVG_PATH:
+            _parse_path_custom(element, canvas_height, transform_origin, transformation, curves, areas)
+
+    return curves, areas